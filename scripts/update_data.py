@@ -1,46 +1,98 @@
+import asyncio
 import csv
-import json
 import os
 import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import lru_cache
 from datetime import date, datetime, timedelta
 from zoneinfo import ZoneInfo
 
-import requests
-from bs4 import BeautifulSoup
+import httpx
+import orjson
 
 
 TZ = ZoneInfo("Asia/Taipei")
 
+REQUEST_TIMEOUT = 30
 
-@dataclass(frozen=True)
+RETRY_TOTAL = 3
+RETRY_BACKOFF_S = 0.5
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+CACHE_DIR = os.path.join(".cache", "twt93u")
+
+
+@lru_cache(maxsize=1)
+def _html_xpaths():
+    # lxml is only needed on the rare HTML fallback path; importing and
+    # compiling here keeps it off the JSON-only startup cost.
+    import lxml.etree
+
+    return (
+        lxml.etree.XPath("//table[1]"),
+        lxml.etree.XPath("(.//thead/tr)[last()]/*[self::th or self::td]"),
+        lxml.etree.XPath(".//tbody/tr"),
+        lxml.etree.XPath(".//tr[td]"),
+        lxml.etree.XPath("./td | ./th"),
+    )
+
+
+@dataclass(frozen=True, slots=True)
 class Table:
     fields: list[str]
-    rows: list[list[str]]
+    rows: list[tuple[str, ...]]
 
 
-def _session() -> requests.Session:
-    session = requests.Session()
-    session.headers.update(
-        {
+def _session() -> httpx.AsyncClient:
+    # TWSE is a single host: HTTP/2 multiplexes all concurrent probes
+    # over one TCP+TLS connection.
+    return httpx.AsyncClient(
+        http2=True,
+        headers={
             "User-Agent": "Mozilla/5.0 (compatible; twse-scraper/1.0; +https://github.com/)",
             "Accept": "application/json,text/html;q=0.9,*/*;q=0.8",
-        }
+            "Accept-Encoding": "gzip, deflate",
+        },
+        timeout=REQUEST_TIMEOUT,
+        limits=httpx.Limits(max_connections=10),
     )
-    return session
 
 
-def _get_json(session: requests.Session, url: str, timeout_s: int = 30) -> dict:
-    resp = session.get(url, timeout=timeout_s)
-    resp.raise_for_status()
-    return resp.json()
+async def _get(session: httpx.AsyncClient, url: str) -> tuple[bytes, str | None]:
+    """GET with backoff on transient statuses and connection errors."""
+    last_err: Exception | None = None
+    for attempt in range(RETRY_TOTAL + 1):
+        if attempt:
+            await asyncio.sleep(RETRY_BACKOFF_S * 2 ** (attempt - 1))
+        try:
+            resp = await session.get(url)
+            if resp.status_code in RETRY_STATUSES:
+                last_err = httpx.HTTPStatusError(
+                    f"{resp.status_code} {resp.reason_phrase}",
+                    request=resp.request,
+                    response=resp,
+                )
+                continue
+            resp.raise_for_status()
+            return resp.content, resp.charset_encoding
+        except httpx.HTTPStatusError:
+            raise
+        except httpx.HTTPError as e:
+            last_err = e
+    assert last_err is not None
+    raise last_err
+
+
+async def _get_json(session: httpx.AsyncClient, url: str) -> dict:
+    body, _ = await _get(session, url)
+    return orjson.loads(body)
 
 
-def _get_html(session: requests.Session, url: str, timeout_s: int = 30) -> str:
-    resp = session.get(url, timeout=timeout_s)
-    resp.raise_for_status()
-    resp.encoding = resp.encoding or "utf-8"
-    return resp.text
+async def _get_html(session: httpx.AsyncClient, url: str) -> str:
+    body, charset = await _get(session, url)
+    return body.decode(charset or "utf-8")
 
 
 def _parse_twse_json_table(payload: dict) -> Table:
@@ -50,52 +102,122 @@ def _parse_twse_json_table(payload: dict) -> Table:
         raise ValueError("Unexpected TWSE JSON shape")
 
     def norm_cell(value: object) -> str:
+        # TWSE payload cells are almost always str already; skip the
+        # redundant str() construction on that path.
+        if type(value) is str:
+            return value.strip()
         if value is None:
             return ""
         return str(value).strip()
 
-    return Table(fields=[str(f).strip() for f in fields], rows=[[norm_cell(c) for c in row] for row in data])
+    return Table(fields=[str(f).strip() for f in fields], rows=[tuple(norm_cell(c) for c in row) for row in data])
+
+
+def _cell_text(el) -> str:
+    return "".join(el.itertext()).strip()
 
 
 def _parse_html_first_table(html: str) -> Table:
-    soup = BeautifulSoup(html, "lxml")
-    table = soup.find("table")
-    if table is None:
-        raise ValueError("No <table> found")
+    import lxml.html
 
-    thead = table.find("thead")
-    if thead is None:
-        raise ValueError("No <thead> found")
+    xpath_table, xpath_head_cells, xpath_body_rows, xpath_any_rows, xpath_row_cells = _html_xpaths()
 
-    header_rows = thead.find_all("tr")
-    if not header_rows:
-        raise ValueError("No header rows")
+    doc = lxml.html.fromstring(html)
+    tables = xpath_table(doc)
+    if not tables:
+        raise ValueError("No <table> found")
+    table = tables[0]
 
-    header_cells = header_rows[-1].find_all(["th", "td"])
-    fields = [c.get_text(strip=True) for c in header_cells]
+    header_cells = xpath_head_cells(table)
+    if not header_cells:
+        raise ValueError("No header rows")
 
-    tbody = table.find("tbody")
-    body_rows = tbody.find_all("tr") if tbody else []
+    fields = [_cell_text(c) for c in header_cells]
 
-    rows: list[list[str]] = []
-    for tr in body_rows:
-        cells = [c.get_text(strip=True) for c in tr.find_all(["td", "th"])]
+    rows: list[tuple[str, ...]] = []
+    for tr in xpath_body_rows(table):
+        cells = tuple(_cell_text(c) for c in xpath_row_cells(tr))
         if cells:
             rows.append(cells)
 
     if not rows:
-        for tr in table.find_all("tr"):
-            tds = tr.find_all("td")
-            if not tds:
-                continue
-            cells = [c.get_text(strip=True) for c in tds]
+        for tr in xpath_any_rows(table):
+            cells = tuple(_cell_text(c) for c in tr.findall("td"))
             if cells:
                 rows.append(cells)
 
     return Table(fields=fields, rows=rows)
 
 
-def fetch_bfi84u(session: requests.Session, base_date_yyyymmdd: str) -> tuple[Table, str]:
+async def _race_json(session: httpx.AsyncClient, urls: list[str]) -> tuple[Table, str]:
+    """Probe all candidate JSON URLs concurrently; first good table wins."""
+
+    async def attempt(url: str) -> tuple[Table, str]:
+        payload = await _get_json(session, url)
+        stat = str(payload.get("stat", "OK")).upper()
+        if "OK" not in stat:
+            raise ValueError(f"TWSE stat not OK: {payload.get('stat')}")
+        table = _parse_twse_json_table(payload)
+        if not table.rows:
+            raise ValueError("No rows")
+        return table, url
+
+    tasks = [asyncio.create_task(attempt(url)) for url in urls]
+    last_err: Exception | None = None
+    try:
+        for fut in asyncio.as_completed(tasks):
+            try:
+                return await fut
+            except Exception as e:
+                last_err = e
+    finally:
+        for task in tasks:
+            task.cancel()
+    assert last_err is not None
+    raise last_err
+
+
+def _cache_path(yyyymmdd: str) -> str:
+    return os.path.join(CACHE_DIR, f"{yyyymmdd}.json")
+
+
+def _load_cached_table(yyyymmdd: str) -> tuple[Table, str] | None:
+    try:
+        with open(_cache_path(yyyymmdd), "rb") as f:
+            entry = orjson.loads(f.read())
+        fields = entry["fields"]
+        url = entry["url"]
+        if not isinstance(fields, list) or not isinstance(entry["rows"], list):
+            return None
+        rows = [tuple(row) for row in entry["rows"]]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return Table(fields=fields, rows=rows), url
+
+
+def _store_cached_table(yyyymmdd: str, table: Table, url: str) -> None:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    entry = {
+        "url": url,
+        "fields": table.fields,
+        "rows": table.rows,
+        "cached_at": datetime.now(TZ).isoformat(),
+    }
+    path = _cache_path(yyyymmdd)
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(entry))
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def _today_yyyymmdd() -> str:
+    return _yyyymmdd(datetime.now(TZ).date())
+
+
+async def fetch_bfi84u(session: httpx.AsyncClient, base_date_yyyymmdd: str) -> tuple[Table, str]:
     candidates = [
         "https://www.twse.com.tw/rwd/zh/marginTrading/BFI84U?response=json",
         f"https://www.twse.com.tw/rwd/zh/marginTrading/BFI84U?response=json&date={base_date_yyyymmdd}",
@@ -104,22 +226,14 @@ def fetch_bfi84u(session: requests.Session, base_date_yyyymmdd: str) -> tuple[Ta
     ]
 
     last_err: Exception | None = None
-    for url in candidates:
-        try:
-            payload = _get_json(session, url)
-            stat = str(payload.get("stat", "OK")).upper()
-            if "OK" not in stat:
-                raise ValueError(f"TWSE stat not OK: {payload.get('stat')}")
-            table = _parse_twse_json_table(payload)
-            if not table.rows:
-                raise ValueError("No rows")
-            return table, url
-        except Exception as e:
-            last_err = e
+    try:
+        return await _race_json(session, candidates)
+    except Exception as e:
+        last_err = e
 
     url = "https://www.twse.com.tw/zh/trading/margin/bfi84u.html"
     try:
-        html = _get_html(session, url)
+        html = await _get_html(session, url)
         table = _parse_html_first_table(html)
         if not table.rows:
             raise ValueError("No rows")
@@ -128,29 +242,38 @@ def fetch_bfi84u(session: requests.Session, base_date_yyyymmdd: str) -> tuple[Ta
         raise RuntimeError(f"Failed to fetch BFI84U: {last_err or e}")
 
 
-def fetch_twt93u(session: requests.Session, yyyymmdd: str) -> tuple[Table, str]:
+async def fetch_twt93u(session: httpx.AsyncClient, yyyymmdd: str) -> tuple[Table, str]:
+    today = _today_yyyymmdd()
+    # Past trading days are immutable, so they can be served from disk.
+    cacheable = yyyymmdd < today
+    if cacheable:
+        cached = _load_cached_table(yyyymmdd)
+        if cached is not None:
+            return cached
+
     candidates = [
         f"https://www.twse.com.tw/rwd/zh/marginTrading/TWT93U?response=json&date={yyyymmdd}",
         f"https://www.twse.com.tw/exchangeReport/TWT93U?response=json&date={yyyymmdd}",
     ]
 
     last_err: Exception | None = None
-    for url in candidates:
-        try:
-            payload = _get_json(session, url)
-            stat = str(payload.get("stat", "OK")).upper()
-            if "OK" not in stat:
-                raise ValueError(f"TWSE stat not OK: {payload.get('stat')}")
-            table = _parse_twse_json_table(payload)
-            if not table.rows:
-                raise ValueError("No rows")
-            return table, url
-        except Exception as e:
-            last_err = e
+    try:
+        table, url = await _race_json(session, candidates)
+        if cacheable:
+            _store_cached_table(yyyymmdd, table, url)
+        return table, url
+    except Exception as e:
+        last_err = e
+
+    # The HTML page takes no date parameter and always shows the current
+    # day, so it is only a valid fallback when today's data was asked
+    # for; past-date probes fail on the JSON endpoints alone.
+    if yyyymmdd != today:
+        raise RuntimeError(f"Failed to fetch TWT93U for {yyyymmdd}: {last_err}")
 
     url = "https://www.twse.com.tw/zh/trading/margin/twt93u.html"
     try:
-        html = _get_html(session, url)
+        html = await _get_html(session, url)
         table = _parse_html_first_table(html)
         if not table.rows:
             raise ValueError("No rows")
@@ -159,14 +282,19 @@ def fetch_twt93u(session: requests.Session, yyyymmdd: str) -> tuple[Table, str]:
         raise RuntimeError(f"Failed to fetch TWT93U for {yyyymmdd}: {last_err or e}")
 
 
-def _find_stock_code_col(fields: list[str]) -> int:
+_CODE_COL_RE = re.compile(r"代號|證券代號|股票代號")
+
+_LATEST_CSV_RE = re.compile(r"^latest-\d{4}-\d{2}-\d{2}\.csv$")
+
+
+def _find_stock_code_col(fields: list[str] | tuple[str, ...]) -> int:
     for i, f in enumerate(fields):
-        if re.search(r"代號|證券代號|股票代號", f):
+        if _CODE_COL_RE.search(f):
             return i
     return 0
 
 
-def _pick_index(fields: list[str], target: str, score_fn) -> int:
+def _pick_index(fields: tuple[str, ...], target: str, score_fn) -> int:
     candidates = [i for i, f in enumerate(fields) if target in f]
     if not candidates:
         raise ValueError(f"Missing column: {target}")
@@ -174,7 +302,10 @@ def _pick_index(fields: list[str], target: str, score_fn) -> int:
     return scored[0][1]
 
 
-def _twt93u_indices(fields: list[str]) -> tuple[int, int, int]:
+@lru_cache(maxsize=8)
+def _twt93u_indices(fields: tuple[str, ...]) -> tuple[int, int, int]:
+    # TWSE headers are stable day to day, so the scoring scans usually
+    # resolve once and hit the cache for the remaining dates.
     code_idx = _find_stock_code_col(fields)
 
     def score_short(i: int) -> int:
@@ -198,25 +329,34 @@ def _twt93u_indices(fields: list[str]) -> tuple[int, int, int]:
 
 
 def _yyyymmdd(d: date) -> str:
-    return d.strftime("%Y%m%d")
+    return f"{d.year:04d}{d.month:02d}{d.day:02d}"
 
 
-def compute_trading_dates(session: requests.Session, base: date, count: int = 5, max_lookback_days: int = 45):
+async def compute_trading_dates(session: httpx.AsyncClient, base: date, count: int = 5, max_lookback_days: int = 45):
     trading: list[date] = []
     tables: dict[str, tuple[Table, str]] = {}
 
-    cursor = base
-    for _ in range(max_lookback_days):
-        ds = _yyyymmdd(cursor)
-        try:
-            table, url = fetch_twt93u(session, ds)
-            trading.append(cursor)
-            tables[ds] = (table, url)
+    dates = [base - timedelta(days=i) for i in range(max_lookback_days)]
+
+    # Fetch in small recent-first waves: the common case resolves within
+    # the first batch (count trading days plus a weekend), so the full
+    # 45-day window is only probed when TWSE has a long holiday gap.
+    batch_size = count + 2
+    for start in range(0, len(dates), batch_size):
+        batch = dates[start : start + batch_size]
+        results = await asyncio.gather(*(fetch_twt93u(session, _yyyymmdd(d)) for d in batch), return_exceptions=True)
+
+        for d, result in zip(batch, results):
+            if isinstance(result, BaseException):
+                continue
+            table, url = result
+            trading.append(d)
+            tables[_yyyymmdd(d)] = (table, url)
             if len(trading) >= count:
                 break
-        except Exception:
-            pass
-        cursor = cursor - timedelta(days=1)
+
+        if len(trading) >= count:
+            break
 
     if len(trading) < count:
         raise RuntimeError(f"Only found {len(trading)} trading days within lookback window")
@@ -233,44 +373,57 @@ def build_twt93u_maps(trading_dates: list[date], tables_by_date: dict[str, tuple
         table, url = tables_by_date[ds]
         source_urls[ds] = url
 
-        code_idx, short_idx, borrow_idx = _twt93u_indices(table.fields)
+        code_idx, short_idx, borrow_idx = _twt93u_indices(tuple(table.fields))
         date_map: dict[str, tuple[str, str]] = {}
 
+        # Codes repeat across the 5 day maps and again in the BFI lookup;
+        # interning them makes those dict probes pointer-equal.
         for row in table.rows:
             if code_idx >= len(row):
                 continue
-            code = row[code_idx].strip()
+            code = row[code_idx]
             if not code:
                 continue
-            short_val = row[short_idx].strip() if short_idx < len(row) else ""
-            borrow_val = row[borrow_idx].strip() if borrow_idx < len(row) else ""
-            date_map[code] = (short_val, borrow_val)
+            short_val = row[short_idx] if short_idx < len(row) else ""
+            borrow_val = row[borrow_idx] if borrow_idx < len(row) else ""
+            date_map[sys.intern(code)] = (short_val, borrow_val)
 
         maps[ds] = date_map
 
     return maps, source_urls
 
 
-def main() -> int:
+def _write_csv(path: str, fields: list[str], rows: list[list[str]]) -> None:
+    with open(path, "w", newline="", encoding="utf-8-sig", buffering=1 << 20) as f:
+        writer = csv.writer(f)
+        writer.writerow(fields)
+        writer.writerows(rows)
+
+
+def _write_json(path: str, payload: dict) -> None:
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(payload))
+
+
+async def main() -> int:
     now = datetime.now(TZ)
     base_date = now.date()
     base_date_iso = base_date.isoformat()
     base_date_yyyymmdd = _yyyymmdd(base_date)
 
-    session = _session()
+    async with _session() as session:
+        print(f"Base date (Taipei): {base_date_iso}")
+        print("Finding last 5 trading dates via TWT93U...")
+        trading_dates, tables_by_date = await compute_trading_dates(session, base_date, count=5)
 
-    print(f"Base date (Taipei): {base_date_iso}")
-    print("Finding last 5 trading dates via TWT93U...")
-    trading_dates, tables_by_date = compute_trading_dates(session, base_date, count=5)
+        print("Fetching BFI84U...")
+        bfi_table, bfi_url = await fetch_bfi84u(session, base_date_yyyymmdd)
 
     trading_dates_iso = [d.isoformat() for d in trading_dates]
     labels = [f"D{-i}" if i else "D0" for i in range(len(trading_dates))]
 
     twt_maps, twt_urls = build_twt93u_maps(trading_dates, tables_by_date)
 
-    print("Fetching BFI84U...")
-    bfi_table, bfi_url = fetch_bfi84u(session, base_date_yyyymmdd)
-
     code_idx = _find_stock_code_col(bfi_table.fields)
 
     appended_fields: list[str] = []
@@ -281,34 +434,45 @@ def main() -> int:
     combined_fields = list(bfi_table.fields) + appended_fields
     combined_rows: list[list[str]] = []
 
+    ordered_maps = [twt_maps[_yyyymmdd(d)] for d in trading_dates]
+    dash = "—"
+    nfixed = len(bfi_table.fields)
+    ncols = len(combined_fields)
+
+    # Cells are already stripped at parse time, so codes are used as-is.
+    # Each output row is filled into a preallocated buffer instead of
+    # concatenating intermediate lists.
     for row in bfi_table.rows:
-        code = row[code_idx].strip() if code_idx < len(row) else ""
-        extras: list[str] = []
-        for d in trading_dates:
-            ds = _yyyymmdd(d)
-            short_val, borrow_val = ("", "")
-            found = twt_maps.get(ds, {}).get(code)
-            if found:
-                short_val, borrow_val = found
-            extras.extend([short_val or "—", borrow_val or "—"])
-        combined_rows.append(list(row) + extras)
+        out = [""] * ncols
+        if len(row) <= nfixed:
+            out[: len(row)] = row
+        else:
+            out[:nfixed] = row[:nfixed]
+        code = sys.intern(row[code_idx]) if code_idx < len(row) else ""
+        i = nfixed
+        for m in ordered_maps:
+            pair = m.get(code)
+            if pair:
+                out[i] = pair[0] or dash
+                out[i + 1] = pair[1] or dash
+            else:
+                out[i] = dash
+                out[i + 1] = dash
+            i += 2
+        combined_rows.append(out)
 
     out_dir = os.path.join("docs", "data")
     os.makedirs(out_dir, exist_ok=True)
 
-    for name in os.listdir(out_dir):
-        if re.match(r"^latest-\d{4}-\d{2}-\d{2}\.csv$", name):
-            os.remove(os.path.join(out_dir, name))
+    with os.scandir(out_dir) as entries:
+        for entry in entries:
+            if _LATEST_CSV_RE.match(entry.name):
+                os.remove(entry.path)
 
     csv_name = f"latest-{base_date_iso}.csv"
     csv_path = os.path.join(out_dir, csv_name)
     json_path = os.path.join(out_dir, "latest.json")
 
-    with open(csv_path, "w", newline="", encoding="utf-8-sig") as f:
-        writer = csv.writer(f)
-        writer.writerow(combined_fields)
-        writer.writerows(combined_rows)
-
     payload = {
         "base_date": base_date_iso,
         "generated_at": now.isoformat(),
@@ -320,8 +484,13 @@ def main() -> int:
         "rows": combined_rows,
     }
 
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False)
+    # The two output files are independent and both disk-bound, so their
+    # writes overlap on a small pool.
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        csv_fut = ex.submit(_write_csv, csv_path, combined_fields, combined_rows)
+        json_fut = ex.submit(_write_json, json_path, payload)
+        csv_fut.result()
+        json_fut.result()
 
     print(f"Wrote {json_path}")
     print(f"Wrote {csv_path}")
@@ -329,4 +498,4 @@ def main() -> int:
 
 
 if __name__ == "__main__":
-    raise SystemExit(main())
\ No newline at end of file
+    raise SystemExit(asyncio.run(main()))